@@ -1,21 +1,84 @@
 import socket
 import logging
+import select
 import pickle
+import struct
 
-from typing import List
+from typing import List, Tuple
 from shared import *
 
 # We maintain a module-level logger.
 logger = logging.getLogger(__name__)
 
+# Ops and responses without content are sent as a two byte control payload (a tag, then the code) instead of a pickle.
+# A pickle (protocol 2 and above) always begins with 0x80, so neither tag can be mistaken for one.
+_CONTROL_PAYLOAD = struct.Struct('>Bb')
+_MESSAGE_LENGTH = struct.Struct('>I')
+_OP_TAG = 0x01
+_RESPONSE_TAG = 0x02
+
 
 class GenericSocketUser(object):
     """ Class to standardize message send and receipt. """
-    # The first portion of a message, the length, is of fixed size. (2^8 maximum message length in bytes)
-    MESSAGE_LENGTH_BYTE_SIZE = 8
+    # The first portion of a message, the length, is of fixed size. (2^32 - 1 maximum message length in bytes)
+    MESSAGE_LENGTH_BYTE_SIZE = _MESSAGE_LENGTH.size
 
     def __init__(self, client_socket: socket.socket = None):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) if client_socket is None else client_socket
+        self.socket = self.new_socket() if client_socket is None else client_socket
+
+    @staticmethod
+    def new_socket() -> socket.socket:
+        """ Create a TCP socket for our frames, with Nagle's algorithm disabled. """
+        working_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        GenericSocketUser.disable_nagle(working_socket)
+        return working_socket
+
+    @staticmethod
+    def disable_nagle(working_socket: socket.socket) -> None:
+        """ Send our (small) frames immediately, instead of holding them back until the previous one is ACKed. """
+        try:
+            working_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            logger.warning(f"Could not set TCP_NODELAY on socket. {e}")
+
+    @staticmethod
+    def _build_frame(message: List) -> Tuple[bytes, bytes]:
+        """ Serialize our message, and compute the length that must precede it. """
+        serialized_message = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        message_length = _MESSAGE_LENGTH.pack(len(serialized_message))
+        return message_length, serialized_message
+
+    @staticmethod
+    def _build_control_frame(tag: int, code: int) -> bytes:
+        """ Build the entire frame (length included) for an op or response without content. """
+        control_payload = _CONTROL_PAYLOAD.pack(tag, code)
+        return _MESSAGE_LENGTH.pack(len(control_payload)) + control_payload
+
+    @staticmethod
+    def _send_frame(working_socket: socket.socket, *frame: bytes) -> None:
+        """ Send all parts of a frame with one gather-write, so small messages leave as a single segment. """
+        poller = select.poll()  # A lone write succeeds against a closed peer, so we check for an EOF beforehand.
+        poller.register(working_socket, select.POLLIN)
+        if poller.poll(0) and working_socket.recv(1, socket.MSG_PEEK) == b'':
+            raise EOFError("Working socket has been closed.")
+
+        bytes_sent = working_socket.sendmsg(frame)
+        if bytes_sent < sum(len(part) for part in frame):  # Short write: send the remainder.
+            working_socket.sendall(b''.join(frame)[bytes_sent:])
+
+    @staticmethod
+    def _receive_exactly(working_socket: socket.socket, byte_count: int) -> bytearray:
+        """ Read exactly byte_count bytes into a buffer sized once, instead of collecting and joining chunks. A new
+        buffer is used per message, as one socket user may be reading from several sockets concurrently. """
+        buffer = bytearray(byte_count)
+        buffer_view, bytes_read, recv_into = memoryview(buffer), 0, working_socket.recv_into
+        while bytes_read < byte_count:
+            chunk_size = recv_into(buffer_view[bytes_read:])
+            if chunk_size == 0:
+                raise EOFError("Working socket has been closed.")
+            bytes_read += chunk_size
+
+        return buffer
 
     def read_message(self, client_socket: socket.socket = None):
         """ Read message_length bytes from the specified socket, and deserialize our message. """
@@ -27,31 +90,14 @@ class GenericSocketUser(object):
             working_socket.settimeout(10)
 
             # Read our message length.
-            chunks, bytes_read = [], 0
-            while bytes_read < GenericSocketUser.MESSAGE_LENGTH_BYTE_SIZE:
-                chunk = working_socket.recv(GenericSocketUser.MESSAGE_LENGTH_BYTE_SIZE - bytes_read)
-                if chunk == b'':
-                    raise EOFError("Working socket has been closed.")
-
-                chunks.append(chunk)
-                bytes_read += len(chunk)
-
-            # Obtain our length.
-            message_length = int.from_bytes(b''.join(chunks), byteorder='big')
+            message_length, = _MESSAGE_LENGTH.unpack(
+                self._receive_exactly(working_socket, GenericSocketUser.MESSAGE_LENGTH_BYTE_SIZE))
             logger.debug(f'Reading message of length: {message_length}')
 
-            # Repeat for the message content.
-            chunks, bytes_read = [], 0
-            while bytes_read < message_length:
-                chunk = working_socket.recv(min(message_length - bytes_read, 2048))
-                if chunk == b'':
-                    raise EOFError("Working socket has been closed.")
-
-                chunks.append(chunk)
-                bytes_read += len(chunk)
-
-            # Reconstruct message, and deserialize.
-            received_message = pickle.loads(b''.join(chunks))
+            # Repeat for the message content, and deserialize.
+            payload = self._receive_exactly(working_socket, message_length)
+            control_code = _CONTROL_CODES.get(bytes(payload)) if message_length == _CONTROL_PAYLOAD.size else None
+            received_message = [control_code] if control_code is not None else pickle.loads(payload)
             logger.debug(f'Received message: {received_message}')
             working_socket.settimeout(working_socket_previous_timeout)
             return received_message
@@ -64,15 +110,12 @@ class GenericSocketUser(object):
     def send_message(self, op_code: OpCode, contents: List, client_socket: socket.socket = None) -> bool:
         """ Correctly format a message to send to another socket user. """
         working_socket = self.socket if client_socket is None else client_socket
-        message = [op_code] + contents
-
-        serialized_message = pickle.dumps(message)
-        message_length = len(serialized_message).to_bytes(GenericSocketUser.MESSAGE_LENGTH_BYTE_SIZE, byteorder='big')
+        # Our op is sent as a plain int, which pickles to a byte or two instead of a reference to its enum class.
+        message_length, serialized_message = self._build_frame([int(op_code)] + contents)
         try:
             logger.debug(f"Sending message length: {len(serialized_message)} | {message_length}")
-            working_socket.sendall(message_length)
             logger.debug(f"Sending message: {serialized_message}.")
-            working_socket.sendall(serialized_message)
+            self._send_frame(working_socket, message_length, serialized_message)
             return True
 
         except Exception as e:
@@ -83,15 +126,9 @@ class GenericSocketUser(object):
     def send_op(self, op_code: OpCode, client_socket: socket.socket = None) -> bool:
         """ Correctly format a OP code to send to another socket user. """
         working_socket = self.socket if client_socket is None else client_socket
-        message = [op_code]
-
-        serialized_message = pickle.dumps(message)
-        message_length = len(serialized_message).to_bytes(GenericSocketUser.MESSAGE_LENGTH_BYTE_SIZE, byteorder='big')
         try:
-            logger.debug(f"Sending message length: {len(serialized_message)} | {message_length}")
-            working_socket.sendall(message_length)
-            logger.debug(f"Sending message: {serialized_message}.")
-            working_socket.sendall(serialized_message)
+            logger.debug(f"Sending op: {op_code}.")
+            self._send_frame(working_socket, _OP_FRAMES[op_code])
             return True
 
         except Exception as e:
@@ -102,15 +139,9 @@ class GenericSocketUser(object):
     def send_response(self, response_code: ResponseCode, client_socket: socket.socket = None) -> bool:
         """ Correctly format a response code to send to another socket user. """
         working_socket = self.socket if client_socket is None else client_socket
-        message = [response_code]
-
-        serialized_message = pickle.dumps(message)
-        message_length = len(serialized_message).to_bytes(GenericSocketUser.MESSAGE_LENGTH_BYTE_SIZE, byteorder='big')
         try:
-            logger.debug(f"Sending message length: {len(serialized_message)} | {message_length}")
-            working_socket.sendall(message_length)
-            logger.debug(f"Sending message: {serialized_message}.")
-            working_socket.sendall(serialized_message)
+            logger.debug(f"Sending response: {response_code}.")
+            self._send_frame(working_socket, _RESPONSE_FRAMES[response_code])
             return True
 
         except Exception as e:
@@ -118,13 +149,33 @@ class GenericSocketUser(object):
             self.close(working_socket)
             return False
 
+    def wait_for_close(self, timeout: float, client_socket: socket.socket = None) -> None:
+        """ Block until our peer closes the socket (i.e. it has read everything we sent), or until the timeout. """
+        working_socket = self.socket if client_socket is None else client_socket
+        try:  # Unlike select(), poll() is not limited to file descriptors below FD_SETSIZE.
+            poller = select.poll()
+            poller.register(working_socket, select.POLLIN)
+            poller.poll(timeout * 1000)
+        except Exception as e:
+            logger.warning(f"Exception caught while waiting for the socket to close: {e}")
+
     def close(self, client_socket: socket.socket = None):
         logger.info("'Close' called. Releasing socket(s).")
         try:
-            if client_socket is not None:
+            if client_socket is not None and client_socket is not self.socket:
                 client_socket.close()
-            if self.socket is not None:
+            if self.socket is not None:  # Our own socket is closed exactly once, even if it was also passed in.
                 self.socket.close()
 
         except Exception as e:
             logger.error(f"Exception caught while trying to close the socket. Swallowing: {e}")
+
+
+# Response codes (and ops sent through send_op) never carry any content, so each of their frames is built once (at
+# import) and reused. Received control payloads are mapped straight back to their codes.
+_RESPONSE_FRAMES = {r: GenericSocketUser._build_control_frame(_RESPONSE_TAG, r) for r in ResponseCode}
+_OP_FRAMES = {o: GenericSocketUser._build_control_frame(_OP_TAG, o) for o in OpCode}
+_CONTROL_CODES = {
+    **{_CONTROL_PAYLOAD.pack(_RESPONSE_TAG, r): r for r in ResponseCode},
+    **{_CONTROL_PAYLOAD.pack(_OP_TAG, o): o for o in OpCode}
+}
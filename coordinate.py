@@ -8,14 +8,34 @@ import logging
 import socket
 import time
 import uuid
+import rm
 
-from multiprocessing.dummy import Pool
+from multiprocessing.pool import ThreadPool
 from typing import List, Tuple
 from shared import *
 
 # We maintain a module-level logger.
 logger = logging.getLogger(__name__)
 
+# All coordinators poll their participants through one pool of threads (given to us as "polling_pool", and sized by
+# "polling-pool-size"), instead of spawning a pool per transaction. Polls block on the network, and a participant that
+# does not answer holds its worker for read_message's full timeout. A few unresponsive sites can then hold up POLLING
+# for every transaction on this node, not just their own, so this pool is sized well above the number of sites we
+# expect to fail at once. Coordinators that are not given a pool (i.e. outside of our manager) share a default one.
+_DEFAULT_POLLING_POOL_SIZE = 16
+_default_polling_pool = None
+_default_polling_pool_lock = threading.Lock()
+
+
+def _get_default_polling_pool() -> ThreadPool:
+    global _default_polling_pool
+
+    with _default_polling_pool_lock:
+        if _default_polling_pool is None:
+            _default_polling_pool = ThreadPool(_DEFAULT_POLLING_POOL_SIZE)
+
+        return _default_polling_pool
+
 
 class CoordinatorStates(IntEnum):
     """ We define 7 distinct states for a coordinator. """
@@ -33,10 +53,19 @@ class TransactionCoordinatorThread(threading.Thread, communication.GenericSocket
         threading.Thread.__init__(self, daemon=True)
         communication.GenericSocketUser.__init__(self)
 
-        self.protocol_db = protocol.ProtocolDatabase(context['protocol_db'])
+        # Borrow a connection to the RM (i.e. Postgres). This is returned as our thread exits, however it exits. If our
+        # pool is exhausted, this raises rm.PoolError before we have opened anything else.
+        self.rm_pool = rm.get_postgres_pool(**context)
+        self.conn = self.rm_pool.getconn()
+        self.cur = self.conn.cursor()  # All of our local statements are executed through this one cursor.
+
+        # Each participant is recorded as it joins (so recovery can always release it), and these commits are shared
+        # with those of other threads.
+        self.protocol_db = protocol.ProtocolDatabase(context['protocol_db'], context.get('group_commit_window'))
         self.socket = client_socket
         self.context = context
         self.active_map = {}
+        self.polling_pool = context.get('polling_pool') or _get_default_polling_pool()
 
         # Initialize our site-list, which describes our cluster.
         self.site_list = self.context['site_list']
@@ -46,14 +75,6 @@ class TransactionCoordinatorThread(threading.Thread, communication.GenericSocket
         self.node_id = [i for i, j in enumerate(self.site_list) if j['alias'] == site_alias][0]
         logger.info(f'Transaction started at node {self.node_id}.')
 
-        # Setup a connection to the RM (i.e. Postgres).
-        self.conn = psycopg2.connect(
-            user=self.context['postgres_username'],
-            password=self.context['postgres_password'],
-            host=self.context['postgres_hostname'],
-            database=self.context['postgres_database']
-        )
-
         # To enter the ABORT / POLLING state instead, parent must explicitly change the state after instantiation.
         self.transaction_id = psycopg2.extensions.Xid.from_string(str(uuid.uuid4()))
         self.state = CoordinatorStates.INITIALIZE
@@ -73,35 +94,44 @@ class TransactionCoordinatorThread(threading.Thread, communication.GenericSocket
             self.state = CoordinatorStates.ABORT
             return
 
-        requested_op = client_message[0]
-        if requested_op == OpCode.INSERT_FROM_CLIENT:
-            statement, hash_input = client_message[2], client_message[3]
-            if not self._execute_statement(statement, hash_input):
-                logger.warning("Statement was not successfully executed. Moving to ABORT state.")
-                self.state = CoordinatorStates.ABORT
+        handler = self._ACTIVE_HANDLERS.get(client_message[0])
+        if handler is not None:
+            handler(self, client_message)
+        else:
+            logger.warning('Unknown operation received. Ignoring. %s', client_message)
 
-        elif requested_op == OpCode.ABORT_TRANSACTION:
+    def _handle_insert(self, client_message):
+        statement, hash_input = client_message[2], client_message[3]
+        if not self._execute_statement(statement, hash_input):
+            logger.warning("Statement was not successfully executed. Moving to ABORT state.")
             self.state = CoordinatorStates.ABORT
 
-        elif requested_op == OpCode.COMMIT_TRANSACTION:
-            try:
-                logger.info("Sending PREPARE to RM.")
-                self.conn.tpc_prepare()
+    def _handle_abort(self, client_message):
+        self.state = CoordinatorStates.ABORT
 
-                if len(self.active_map) != 0:
-                    logger.info("RM has approved of PREPARE. Moving to POLLING state.")
-                    self.state = CoordinatorStates.POLLING
-                else:
-                    logger.info("RM has approved of PREPARE and is the sole site. Moving to COMMIT state.")
-                    self.state = CoordinatorStates.COMMIT
+    def _handle_commit(self, client_message):
+        try:
+            logger.info("Sending PREPARE to RM.")
+            self.conn.tpc_prepare()
 
-            except Exception as e:
-                logger.warning(f"RM could not PREPARE. Moving to ABORT state. Exception: {e}")
-                self.conn.tpc_rollback()
-                self.state = CoordinatorStates.ABORT
+            if len(self.active_map) != 0:
+                logger.info("RM has approved of PREPARE. Moving to POLLING state.")
+                self.state = CoordinatorStates.POLLING
+            else:
+                logger.info("RM has approved of PREPARE and is the sole site. Moving to COMMIT state.")
+                self.state = CoordinatorStates.COMMIT
 
-        else:
-            logger.warning('Unknown operation received. Ignoring. ', client_message)
+        except Exception as e:
+            logger.warning(f"RM could not PREPARE. Moving to ABORT state. Exception: {e}")
+            self.state = CoordinatorStates.ABORT
+
+    # In the ACTIVE state, each op from our client is handled with a single lookup. Received ops are plain ints, which
+    # hash (and compare) equal to their OpCode members.
+    _ACTIVE_HANDLERS = {
+        OpCode.INSERT_FROM_CLIENT: _handle_insert,
+        OpCode.ABORT_TRANSACTION: _handle_abort,
+        OpCode.COMMIT_TRANSACTION: _handle_commit
+    }
 
     def _polling_state(self):
         def _poll_participants(participant: int, participant_socket: socket.socket) -> bool:
@@ -113,11 +143,8 @@ class TransactionCoordinatorThread(threading.Thread, communication.GenericSocket
             return participant_response is not None and participant_response[0] == \
                    ResponseCode.PREPARED_FROM_PARTICIPANT
 
-        thread_pool = Pool(4)  # For now, this is a hard-coded value.
         logger.info("Now polling participants (moving polling to thread pool).")
-        is_successful = thread_pool.starmap(_poll_participants, self.active_map.items())
-        thread_pool.close()
-        thread_pool.join()
+        is_successful = self.polling_pool.starmap(_poll_participants, self.active_map.items())
 
         if all(is_successful):
             logger.info("All participants have agreed to COMMIT. Moving to COMMIT state.")
@@ -128,6 +155,10 @@ class TransactionCoordinatorThread(threading.Thread, communication.GenericSocket
 
     def _abort_state(self):
         self.protocol_db.log_abort_of(str(self.transaction_id))
+        if self.conn.status != psycopg2.extensions.STATUS_READY:  # Our work is still open (or prepared) on our RM.
+            logger.info("Sending ROLLBACK to RM.")
+            self.conn.tpc_rollback()
+
         self._final_multicast(OpCode.ROLLBACK_FROM_COORDINATOR)
 
         if len(self.active_map) != 0:
@@ -152,13 +183,14 @@ class TransactionCoordinatorThread(threading.Thread, communication.GenericSocket
         while len(self.active_map) != 0:
             logger.info("Reconnecting disconnected participants.")
 
-            for participant_id in self.active_map.keys():
+            active_map, site_list = self.active_map, self.site_list
+            for participant_id in active_map.keys():
                 logger.info(f"Connecting to participant {participant_id}.")
-                working_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                working_site = self.site_list[participant_id]
+                working_socket = self.new_socket()
+                working_site = site_list[participant_id]
 
                 try:
-                    self.active_map[participant_id] = working_socket
+                    active_map[participant_id] = working_socket
                     working_socket.connect((working_site['hostname'], working_site['port']))
 
                 except Exception as e:  # Swallow exceptions here. We will attempt to connect at a later time.
@@ -178,10 +210,17 @@ class TransactionCoordinatorThread(threading.Thread, communication.GenericSocket
         if self.socket is not None:  # This means that we do not have a connection with the client.
             self.send_response(ResponseCode.TRANSACTION_COMMITTED if self.previous_state == CoordinatorStates.COMMIT
                                else ResponseCode.TRANSACTION_ABORTED)
-            time.sleep(1)  # Wait for client to acknowledge the response.
+            self.wait_for_close(1)  # Wait (at most a second) for client to acknowledge the response.
 
-        self.protocol_db.close()
+    def _release(self):
+        """ Release our resources, however we have exited. Our RM connection always goes back to the pool, as the pool
+        is shared and capped. A connection we did not finish with (e.g. an exception left it mid-transaction, or it was
+        dropped) is closed instead of being handed to another thread. """
         self.close()
+        self.protocol_db.close()
+        if not self.conn.closed:
+            self.cur.close()
+        self.rm_pool.putconn(self.conn, close=bool(self.conn.closed) or self.state != CoordinatorStates.FINISHED)
 
     def _remove_participants(self, participants_to_remove: List):
         """ Given a list of node-ids, remove the given participants from our active map set. """
@@ -198,8 +237,7 @@ class TransactionCoordinatorThread(threading.Thread, communication.GenericSocket
             logger.debug("Insertion is meant to be performed locally. Running statement.")
             try:
                 # Execute the statement, if we are the endpoint.
-                cur = self.conn.cursor()
-                cur.execute(statement)
+                self.cur.execute(statement)
                 logger.debug(f"{statement} successful.")
                 self.send_response(ResponseCode.OK)
                 return True
@@ -218,7 +256,7 @@ class TransactionCoordinatorThread(threading.Thread, communication.GenericSocket
                 endpoint = self.site_list[endpoint_index]  # Determine entry in site_list.
                 logger.debug(f"Endpoint entry is {endpoint}.")
 
-                self.active_map[endpoint_index] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.active_map[endpoint_index] = self.new_socket()
                 try:
                     self.active_map[endpoint_index].connect((endpoint['hostname'], endpoint['port'],))
                     self.protocol_db.add_participant(str(self.transaction_id), endpoint_index)
@@ -235,7 +273,7 @@ class TransactionCoordinatorThread(threading.Thread, communication.GenericSocket
 
             endpoint_response = self.read_message(self.active_map[endpoint_index])
             logger.debug(f"Received response from endpoint: {endpoint_response}")
-            if endpoint_response[0] == ResponseCode.OK:
+            if endpoint_response is not None and endpoint_response[0] == ResponseCode.OK:
                 self.send_response(ResponseCode.OK)
                 return True
             else:
@@ -246,23 +284,32 @@ class TransactionCoordinatorThread(threading.Thread, communication.GenericSocket
         """ Given our active participants, send an op-code to each. Remove those who acknowledge. """
         participants_to_remove = []  # Avoid in-place deletion while iterating.
 
+        # Resolve everything that is constant across our participants once, instead of once per participant.
+        failure_time, message_contents = self.context['failure_time'], [str(self.transaction_id)]
+        send_message, read_message = self.send_message, self.read_message
+
+        # Our decision goes out to every participant before we wait on any of them, so their acknowledgements are
+        # collected in (roughly) one round trip instead of one round trip per participant.
+        notified_participants = []
         for participant, participant_socket in self.active_map.items():
             try:
-                participant_socket.settimeout(self.context['failure_time'])
+                participant_socket.settimeout(failure_time)
             except OSError as e:
                 logger.warning(f"Could not set socket timeout. {e}")
                 continue
 
             logger.info(f"Sending {op_code} to participant {participant}.")
-            self.send_message(op_code, [str(self.transaction_id)], participant_socket)  # Swallow the error.
+            send_message(op_code, message_contents, participant_socket)  # Swallow the error.
+            notified_participants.append((participant, participant_socket,))
 
+        for participant, participant_socket in notified_participants:
             # Break symmetry of the coordinator asking for acknowledgement while the participant asks for the status.
-            participant_response = self.read_message(participant_socket)
+            participant_response = read_message(participant_socket)
             if participant_response is not None and participant_response[0] == OpCode.TRANSACTION_STATUS:
                 logger.info(f"Participant {participant} is requesting the status of the transaction.")
                 logger.info(f"Resending {op_code} to participant {participant}.")
-                self.send_message(op_code, [str(self.transaction_id)], participant_socket)  # Swallow the error.
-                participant_response = self.read_message(participant_socket)
+                send_message(op_code, message_contents, participant_socket)  # Swallow the error.
+                participant_response = read_message(participant_socket)
 
             if participant_response is not None and participant_response[0] == ResponseCode.ACKNOWLEDGE_END:
                 logger.info(f"Participant {participant} has acknowledged {op_code}.")
@@ -274,31 +321,25 @@ class TransactionCoordinatorThread(threading.Thread, communication.GenericSocket
 
         self._remove_participants(participants_to_remove)
 
-    def run(self) -> None:
-        while self.state != CoordinatorStates.FINISHED:
-            if self.state == CoordinatorStates.INITIALIZE:
-                logger.info("Moving to INITIALIZE state.")
-                self._initialize_state()
-
-            elif self.state == CoordinatorStates.ACTIVE:
-                logger.info("Moving to ACTIVE state.")
-                self._active_state()
+    # Handlers are indexed by the value of their state, so each hop is a single subscript instead of a walk down an
+    # if / elif chain. This must follow the order of CoordinatorStates.
+    _STATE_HANDLERS = (
+        _initialize_state,  # CoordinatorStates.INITIALIZE
+        _active_state,  # CoordinatorStates.ACTIVE
+        _polling_state,  # CoordinatorStates.POLLING
+        _abort_state,  # CoordinatorStates.ABORT
+        _commit_state,  # CoordinatorStates.COMMIT
+        _waiting_state  # CoordinatorStates.WAITING
+    )
 
-            elif self.state == CoordinatorStates.POLLING:
-                logger.info("Moving to POLLING state.")
-                self._polling_state()
-
-            elif self.state == CoordinatorStates.ABORT:
-                logger.info("Moving to ABORT state.")
-                self._abort_state()
-
-            elif self.state == CoordinatorStates.WAITING:
-                logger.info("Moving to WAITING state.")
-                self._waiting_state()
+    def run(self) -> None:
+        try:
+            while self.state != CoordinatorStates.FINISHED:
+                logger.info(f"Moving to {self.state.name} state.")
+                self._STATE_HANDLERS[self.state](self)
 
-            elif self.state == CoordinatorStates.COMMIT:
-                logger.info("Moving to COMMIT state.")
-                self._commit_state()
+            logger.info("Moving to FINISHED state. Exiting thread.")
+            self._finished_state()
 
-        logger.info("Moving to FINISHED state. Exiting thread.")
-        self._finished_state()
+        finally:
+            self._release()
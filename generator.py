@@ -2,10 +2,10 @@
 import __init__  # Stupid way to get logging to work...
 
 import communication
+import collections
 import argparse
 import datetime
 import logging
-import socket
 import json
 import time
 import sys
@@ -16,6 +16,10 @@ from shared import *
 # We maintain a module-level logger.
 logger = logging.getLogger(__name__)
 
+# Characters stripped from the timestamp and sensor ID fields of a workload record, each in a single pass.
+_TIMESTAMP_DELETIONS = str.maketrans('', '', " '")
+_SENSOR_ID_DELETIONS = str.maketrans('', '', ");' ")
+
 
 class _TransactionGenerator(communication.GenericSocketUser):
     def __init__(self, **context):
@@ -46,7 +50,7 @@ class _TransactionGenerator(communication.GenericSocketUser):
             hostname, port = self.context['coordinator_hostname'], int(self.context['coordinator_port'])
             logger.info(f"Socket is closed. Reconnecting to TM at {hostname} through port {port}.")
             try:
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.socket = self.new_socket()
                 self.socket.connect((hostname, port))
                 self.is_socket_closed = False
             except Exception as e:
@@ -92,10 +96,9 @@ class _TransactionGenerator(communication.GenericSocketUser):
 
     @staticmethod
     def _convert_timestamp(timestamp):
-        timestamp = timestamp.replace(" ", "")
-        timestamp = timestamp.replace("'", "")
-        timestamp = timestamp[0:10] + " " + timestamp[10:]
-        return datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+        # Our timestamps are ISO formatted, which fromisoformat parses in C (strptime walks its format string per call).
+        timestamp = timestamp.translate(_TIMESTAMP_DELETIONS)
+        return datetime.datetime.fromisoformat(timestamp[0:10] + " " + timestamp[10:])
 
     def _perform_transaction(self, insert_list: List):
         transaction_id = self._start_transaction()
@@ -117,7 +120,7 @@ class _TransactionGenerator(communication.GenericSocketUser):
             logger.info(f"Exception caught. Attempting to connect socket again before retry.")
             hostname, port = self.context['coordinator_hostname'], int(self.context['coordinator_port'])
             logger.info(f"Connecting to TM at {hostname} through port {port}.")
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket = self.new_socket()
             self.socket.connect((hostname, port))
             self.is_socket_closed = False
 
@@ -135,34 +138,29 @@ class _TransactionGenerator(communication.GenericSocketUser):
         cur_timestamp = cur_timestamp + datetime.timedelta(seconds=self.context['time_delta'])
         file_r.seek(0)
 
-        sensor_dict = {}
-        while True:
+        # We iterate over our (buffered) file instead of calling readline() per record, and split each record once.
+        sensor_dict = collections.defaultdict(list)
+        for record in file_r:
             try:
-                record = file_r.readline().rstrip()
+                record = record.rstrip()
                 if record == "":
                     logger.info('Blank line found. Exiting.')
                     break
 
-                timestamp = self._convert_timestamp(record.split(",")[-2])
-                sensor_id = record.split(",")[-1] \
-                    .replace(")", "") \
-                    .replace(";", "") \
-                    .replace("'", "") \
-                    .replace(" ", "")
+                record_fields = record.rsplit(",", 2)
+                timestamp = self._convert_timestamp(record_fields[-2])
+                sensor_id = record_fields[-1].translate(_SENSOR_ID_DELETIONS)
 
                 if timestamp <= cur_timestamp:
                     logger.debug(f'Processing: {record}, ({sensor_id}, {timestamp})')
-                    if sensor_id in sensor_dict:
-                        sensor_dict[sensor_id].append([record, (sensor_id, timestamp,)])
-                    else:
-                        sensor_dict[sensor_id] = [[record, (sensor_id, timestamp,)]]
+                    sensor_dict[sensor_id].append((record, (sensor_id, timestamp,)))  # Our hash input needs the ID.
 
                 else:
                     for (k, v) in sensor_dict.items():
                         self._perform_transaction(v)
 
                     cur_timestamp = cur_timestamp + datetime.timedelta(0, self.context['time_delta'])
-                    sensor_dict = {}
+                    sensor_dict = collections.defaultdict(list)
 
             except Exception as e:
                 logger.error(f'Exception caught: {e}\n {sys.exc_info()[-1].tb_lineno}')
@@ -6,14 +6,15 @@ import participate
 import coordinate
 import threading
 import protocol
-import psycopg2
 import argparse
 import logging
 import socket
 import time
 import json
 import abc
+import rm
 
+from multiprocessing.pool import ThreadPool
 from typing import Union
 from shared import *
 
@@ -81,12 +82,18 @@ class TransactionManagerThread(threading.Thread, communication.GenericSocketUser
         if protocol_db.get_role_in(transaction_id) == TransactionRole.PARTICIPANT:
             # Determine who our coordinator is, and get the transaction status.
             coordinator_id = protocol_db.get_coordinator_for(transaction_id)
-            coordinator_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            coordinator_socket = self.new_socket()
             coordinator_socket.connect(
                 (self.site_list[coordinator_id]['hostname'], self.site_list[coordinator_id]['port']), )
             logger.info(f"Connecting to coordinator: {self.site_list[coordinator_id]['hostname']}.")
 
-            participant_thread = self.role_factory.get_participant(coordinator_id, transaction_id, coordinator_socket)
+            try:
+                participant_thread = self.role_factory.get_participant(coordinator_id, transaction_id,
+                                                                       coordinator_socket)
+            except rm.PoolError:
+                coordinator_socket.close()
+                raise
+
             logger.info(f"Spawning participant thread in the ABORT state.")
             participant_thread.state = participate.ParticipantStates.ABORT
             self.child_threads[transaction_id] = participant_thread
@@ -103,7 +110,7 @@ class TransactionManagerThread(threading.Thread, communication.GenericSocketUser
             logger.info(f"We are aware of the following participants {participant_ids}.")
             for participant_id in participant_ids:
                 logger.info(f"Connecting to participant {participant_id}.")
-                working_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                working_socket = self.new_socket()
                 working_site = self.site_list[participant_id]
 
                 try:
@@ -120,12 +127,18 @@ class TransactionManagerThread(threading.Thread, communication.GenericSocketUser
         if protocol_db.get_role_in(transaction_id) == TransactionRole.PARTICIPANT:
             # Determine who our coordinator is, and get the transaction status.
             coordinator_id = protocol_db.get_coordinator_for(transaction_id)
-            coordinator_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            coordinator_socket = self.new_socket()
             coordinator_socket.connect(
                 (self.site_list[coordinator_id]['hostname'], self.site_list[coordinator_id]['port']), )
             logger.info(f"Connecting to coordinator: {self.site_list[coordinator_id]['hostname']}.")
 
-            participant_thread = self.role_factory.get_participant(coordinator_id, transaction_id, coordinator_socket)
+            try:
+                participant_thread = self.role_factory.get_participant(coordinator_id, transaction_id,
+                                                                       coordinator_socket)
+            except rm.PoolError:
+                coordinator_socket.close()
+                raise
+
             logger.info(f"Spawning participant thread in the PREPARED state.")
             participant_thread.state = participate.ParticipantStates.PREPARED
             self.child_threads[transaction_id] = participant_thread
@@ -142,7 +155,7 @@ class TransactionManagerThread(threading.Thread, communication.GenericSocketUser
             logger.info(f"We are aware of the following participants {participant_ids}.")
             for participant_id in participant_ids:
                 logger.info(f"Connecting to participant {participant_id}.")
-                working_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                working_socket = self.new_socket()
                 working_site = self.site_list[participant_id]
 
                 try:
@@ -159,25 +172,24 @@ class TransactionManagerThread(threading.Thread, communication.GenericSocketUser
         # Initialize our site-list, which describes our cluster.
         logger.info(f"TM is aware of site: {self.site_list}")
 
-        # Setup a connection to the RM (i.e. Postgres).
-        recovery_conn = psycopg2.connect(
-            user=self.context['postgres_username'],
-            password=self.context['postgres_password'],
-            host=self.context['postgres_hostname'],
-            database=self.context['postgres_database']
-        ) if 'test_rm' not in self.context else self.context['test_rm']
         protocol_db = protocol.ProtocolDatabase(self.context['protocol_db'])
 
+        # If our RM pool is exhausted, a transaction is left as it is in our log (and in our RM) for the next recovery.
         for transaction_id in protocol_db.get_abortable_transactions():
             logger.info(f"Working on to-be-aborted transaction {transaction_id}.")
-            self._abort_transaction(protocol_db, transaction_id)
+            try:
+                self._abort_transaction(protocol_db, transaction_id)
+            except rm.PoolError as e:
+                logger.error(f"No RM connection is available. Leaving transaction {transaction_id} for now. {e}")
 
         for transaction_id in protocol_db.get_prepared_transactions():
             logger.info(f"Working on prepared transaction {transaction_id}.")
-            self._recover_transaction(protocol_db, transaction_id)
+            try:
+                self._recover_transaction(protocol_db, transaction_id)
+            except rm.PoolError as e:
+                logger.error(f"No RM connection is available. Leaving transaction {transaction_id} for now. {e}")
 
         # We are done with recovery.
-        recovery_conn.close()
         protocol_db.close()
         self.state = TransactionManagerStates.INITIALIZE
 
@@ -199,6 +211,7 @@ class TransactionManagerThread(threading.Thread, communication.GenericSocketUser
         try:
             client_socket, client_address = self.socket.accept()
             logger.info(f"Connection accepted from {client_address}.")
+            self.disable_nagle(client_socket)  # Not every platform carries this over from our listening socket.
         except Exception as e:
             logger.warning(f"Exception caught: {e}.")
             logger.warning(f"Could not accept the connection. Moving back to the INITIALIZE state.")
@@ -224,7 +237,13 @@ class TransactionManagerThread(threading.Thread, communication.GenericSocketUser
         elif requested_op == OpCode.START_TRANSACTION:
             # Our transaction originates at this TM. Spawn a separate thread to handle this client.
             logger.info("Transaction has been started. Spawning coordinator thread.")
-            coordinator_thread = self.role_factory.get_coordinator(client_socket)
+            try:
+                coordinator_thread = self.role_factory.get_coordinator(client_socket)
+            except rm.PoolError as e:  # Our client reads a closed socket as a failure to start.
+                logger.warning(f"No RM connection is available. Rejecting transaction. {e}")
+                client_socket.close()
+                return
+
             self.child_threads[coordinator_thread.transaction_id] = coordinator_thread
             self.send_message(OpCode.START_TRANSACTION, [str(coordinator_thread.transaction_id)], client_socket)
             coordinator_thread.start()
@@ -235,43 +254,47 @@ class TransactionManagerThread(threading.Thread, communication.GenericSocketUser
 
             # We are a part of a transaction that does not originate at this TM. Spawn a participant.
             logger.info(f"We are a participant in transaction {transaction_id}. Spawning participant.")
-            self.child_threads[transaction_id] = self.role_factory \
-                .get_participant(coordinator_id, transaction_id, client_socket)
-            self.child_threads[transaction_id].start()
+            try:
+                participant_thread = self.role_factory.get_participant(coordinator_id, transaction_id, client_socket)
+            except rm.PoolError as e:  # Our coordinator reads a closed socket as a failed statement, and aborts.
+                logger.warning(f"No RM connection is available. Rejecting transaction {transaction_id}. {e}")
+                client_socket.close()
+                return
+
+            self.child_threads[transaction_id] = participant_thread
+            participant_thread.start()
 
         elif requested_op == OpCode.COMMIT_FROM_COORDINATOR or requested_op == OpCode.ROLLBACK_FROM_COORDINATOR \
                 or requested_op == OpCode.PREPARE_TO_COMMIT:
             # Parse the transaction ID from the message.
             transaction_id = client_message[1]
 
-            if transaction_id not in self.child_threads.keys() or \
-                    (transaction_id in self.child_threads.keys() and not self.child_threads[transaction_id].is_alive()):
+            child_thread = self.child_threads.get(transaction_id)  # Hash our transaction ID once, not three times.
+            if child_thread is None or not child_thread.is_alive():
                 logger.info(f"We have no knowledge of transaction {transaction_id}. Replying with ACK.")
                 self.send_response(ResponseCode.ACKNOWLEDGE_END, client_socket)
-                time.sleep(0.5)  # Wait for coordinator to receive our acknowledgement.
+                self.wait_for_close(0.5, client_socket)  # Wait for coordinator to receive our acknowledgement.
                 client_socket.close()
 
             else:
-                logger.info(f"Injecting socket {client_socket} to participant {self.child_threads[transaction_id]}.")
-                self.child_threads[transaction_id].inject_socket(client_socket)
+                logger.info(f"Injecting socket {client_socket} to participant {child_thread}.")
+                child_thread.inject_socket(client_socket)
 
         else:
             logger.warning(f"Unknown/unsupported operation received. Taking no action. {client_message}")
 
+    # Handlers are indexed by the value of their state. This must follow the order of TransactionManagerStates.
+    _STATE_HANDLERS = (
+        _recovery_state,  # TransactionManagerStates.RECOVERY
+        _initialize_state,  # TransactionManagerStates.INITIALIZE
+        _active_state  # TransactionManagerStates.ACTIVE
+    )
+
     def run(self) -> None:
         logger.info("Starting instance of TM daemon.")
         while self.state != TransactionManagerStates.FINISHED:
-            if self.state == TransactionManagerStates.RECOVERY:
-                logger.info("Moving to RECOVERY state.")
-                self._recovery_state()
-
-            elif self.state == TransactionManagerStates.INITIALIZE:
-                logger.info("Moving to INITIALIZE state.")
-                self._initialize_state()
-
-            elif self.state == TransactionManagerStates.ACTIVE:
-                logger.info("Moving to ACTIVE state.")
-                self._active_state()
+            logger.info(f"Moving to {self.state.name} state.")
+            self._STATE_HANDLERS[self.state](self)
 
         logger.info("Moving to FINISHED state.")
         logger.info("Waiting for all child threads to stop.")
@@ -294,16 +317,33 @@ if __name__ == '__main__':
     with open(c_args.config_path + '/site.json') as site_config_file:
         site_json = json.load(site_config_file)
 
+    # We spawn a thread per transaction (and role), most of which are blocked on a socket. Shrink their stacks.
+    threading.stack_size(manager_json['thread-stack-size'])
+
+    postgres_context = {
+        'postgres_pool_size': manager_json['postgres-pool-size'],
+        'postgres_username': postgres_json['user'],
+        'postgres_password': postgres_json['password'],
+        'postgres_hostname': postgres_json['host'],
+        'postgres_database': postgres_json['database']
+    }
+
+    # Open our RM connection pool now, instead of on our first transaction.
+    rm.get_postgres_pool(**postgres_context)
+
+    # Every coordinator polls its participants through this one pool of threads, so it is built (and sized) once here.
+    polling_pool = ThreadPool(manager_json['polling-pool-size'])
+
     TransactionManagerThread(
         site_alias=c_args.site_alias,
         node_port=manager_json['node-port'],
 
         failure_time=manager_json['failure-time'],
         protocol_db=manager_json['protocol-db'],
+        group_commit_window=manager_json['group-commit-window'],
+        participant_cpus=manager_json['participant-cpus'],
+        polling_pool=polling_pool,
+        socket_buffer_size=manager_json.get('socket-buffer-size'),
         site_list=site_json,
-
-        postgres_username=postgres_json['user'],
-        postgres_password=postgres_json['password'],
-        postgres_hostname=postgres_json['host'],
-        postgres_database=postgres_json['database']
+        **postgres_context
     ).run()
@@ -1,19 +1,89 @@
 """ This file contains all participant related functionality. """
 import psycopg2.extensions
 import communication
+import collections
+import itertools
 import threading
 import psycopg2
 import protocol
 import logging
+import weakref
 import socket
-import queue
+import os
+import rm
+import re
 
-from typing import Any
+from typing import Any, List
 from shared import *
 
 # We maintain a module-level logger.
 logger = logging.getLogger(__name__)
 
+# Socket buffers are left to the kernel's autotuning unless "socket-buffer-size" is given (e.g. to size them for a
+# cluster's bandwidth-delay product). TCP_QUICKACK is only available on Linux.
+_TCP_QUICKACK = getattr(socket, 'TCP_QUICKACK', None)
+
+# Participants can be spread round-robin across a fixed set of CPUs (the "participant-cpus" setting), which keeps each
+# thread's socket and RM connection state in one core's caches. Thread affinity is only available on Linux.
+_participant_cpu_counter = itertools.count()
+
+
+def _pin_to_cpu(cpus: List[int]) -> None:
+    """ Pin the calling thread to the next CPU in the given list. """
+    if not hasattr(os, 'sched_setaffinity'):
+        return
+
+    cpu = cpus[next(_participant_cpu_counter) % len(cpus)]
+    try:
+        os.sched_setaffinity(0, {cpu})  # On Linux, 0 refers to the calling thread (not the entire process).
+    except OSError as e:
+        logger.warning("Could not pin participant to CPU %s. %s", cpu, e)
+
+
+# INSERTs from the coordinator are of the form "insert into <table> values (<literal>, ...);". Only string and numeric
+# literals can be passed to EXECUTE as parameters (e.g. DEFAULT cannot), so anything else is left to Postgres.
+_INSERT_PATTERN = re.compile(r"^\s*insert\s+into\s+(\w+)\s+values\s*\((.*)\)\s*;?\s*$", re.IGNORECASE | re.DOTALL)
+_VALUE_PATTERN = re.compile(r"\s*('(?:[^']|'')*'|[+-]?\d[\w.]*)\s*(?:,|$)")
+
+# Pooled connections outlive our participants, so we remember which INSERTs have been prepared on each. A connection
+# object never reconnects (a broken one is replaced with a new object), so a connection's entry is valid for its life.
+# Prepared statements hold memory in their backend, so we keep at most _MAX_PREPARED_INSERTS per connection.
+_prepared_inserts = weakref.WeakKeyDictionary()
+_MAX_PREPARED_INSERTS = 64
+
+
+def _as_prepared_insert(cur, statement: str) -> str:
+    """ Rewrite a simple INSERT to EXECUTE a statement prepared (once) on our connection, so Postgres parses and plans
+    each table's INSERT once instead of per statement. Any other statement is returned as-is. """
+    insert_match = _INSERT_PATTERN.match(statement)
+    if insert_match is None:
+        return statement
+    table, values = insert_match.groups()
+
+    value_count, position = 0, 0
+    while position < len(values):
+        value_match = _VALUE_PATTERN.match(values, position)
+        if value_match is None:
+            return statement  # Not a list of plain literals, leave this to Postgres.
+        value_count, position = value_count + 1, value_match.end()
+    if value_count == 0:
+        return statement
+
+    statement_name = f'ins_{table.lower()}_{value_count}'
+    prepared_names = _prepared_inserts.setdefault(cur.connection, collections.OrderedDict())
+    if statement_name in prepared_names:
+        prepared_names.move_to_end(statement_name)
+
+    else:
+        if len(prepared_names) >= _MAX_PREPARED_INSERTS:  # Evict our least recently used statement.
+            cur.execute(f'DEALLOCATE {prepared_names.popitem(last=False)[0]}')
+
+        parameters = ', '.join(f'${i + 1}' for i in range(value_count))
+        cur.execute(f'PREPARE {statement_name} AS INSERT INTO {table} VALUES ({parameters})')
+        prepared_names[statement_name] = None
+
+    return f'EXECUTE {statement_name}({values})'
+
 
 class ParticipantStates(IntEnum):
     """ We define 7 distinct states for a participant. """
@@ -26,238 +96,312 @@ class ParticipantStates(IntEnum):
     FINISHED = 6
 
 
+# In the PREPARED state, the coordinator's decision is all that we wait for.
+_PREPARED_NEXT_STATES = {
+    OpCode.COMMIT_FROM_COORDINATOR: ParticipantStates.COMMIT,
+    OpCode.ROLLBACK_FROM_COORDINATOR: ParticipantStates.ABORT
+}
+
+# Upon leaving the WAITING state, the coordinator's reply decides where we go next.
+_WAITING_NEXT_STATES = {
+    OpCode.COMMIT_FROM_COORDINATOR: ParticipantStates.COMMIT,
+    ResponseCode.TRANSACTION_COMMITTED: ParticipantStates.COMMIT,
+    OpCode.ROLLBACK_FROM_COORDINATOR: ParticipantStates.ABORT,
+    ResponseCode.TRANSACTION_ABORTED: ParticipantStates.ABORT
+}
+
+
 class TransactionParticipantThread(threading.Thread, communication.GenericSocketUser):
     def __init__(self, transaction_id: str, client_socket: socket.socket, **context):
         communication.GenericSocketUser.__init__(self, client_socket)
         threading.Thread.__init__(self, daemon=True)
 
-        self.protocol_db = protocol.ProtocolDatabase(context['protocol_db'])
+        # Borrow a connection to the RM (i.e. Postgres). This is returned as our thread exits, however it exits. If our
+        # pool is exhausted, this raises rm.PoolError before we have opened anything else.
+        self.rm_pool = rm.get_postgres_pool(**context)
+        self.conn = self.rm_pool.getconn()
+
+        self.protocol_db = protocol.ProtocolDatabase(context['protocol_db'], context.get('group_commit_window'))
         self.transaction_coordinator = context['transaction_coordinator']
-        self.context = context
-
-        # Setup a connection to the RM (i.e. Postgres).
-        self.conn = psycopg2.connect(
-            user=context['postgres_username'],
-            password=context['postgres_password'],
-            host=context['postgres_hostname'],
-            database=context['postgres_database']
-        )
+        self.failure_time = context['failure_time']
+        self.participant_cpus = context.get('participant_cpus')
+        self.socket_buffer_size = context.get('socket_buffer_size')
+
         self.transaction_id = psycopg2.extensions.Xid.from_string(transaction_id)
+        self.transaction_id_str = str(self.transaction_id)  # Used as our key in the protocol database.
         self.conn.autocommit = False
         self.conn.tpc_begin(self.transaction_id)
+        self.cur = self.conn.cursor()  # All of our statements are executed through this one cursor.
 
         # To enter the PREPARE / ABORT state instead, parent must explicitly change the state after instantiation.
         self.state = ParticipantStates.INITIALIZE
-        self.socket_token = queue.Queue(1)
+        self.socket_injected = threading.Event()
+        self.socket_lock = threading.Lock()
         self.previous_edge_property = None
         self.is_prepared = False
+        self.initialize_request = None
+        self._tune_socket()
 
-    def _send_edge(self, content) -> Any:
-        try:  # If we are unable to set the timeout, then the socket is closed.
-            self.socket.settimeout(self.context['failure_time'])
-        except OSError as e:
-            self.previous_edge_property = content
-            logger.warning(f"Could not set socket timeout. {e}")
-            return None if type(content) == OpCode else False
-
-        if type(content) == OpCode:
-            if not self.send_op(content):
-                logger.warning("Unable to send request for transaction status. Moving to WAITING.")
-                self.previous_edge_property = content
-                self.state = ParticipantStates.WAITING
-                return None
-
-            coordinator_response = self.read_message()
-            if coordinator_response is None:
-                logger.warning("No reply from the coordinator about transaction status. Moving to WAITING.")
-                self.previous_edge_property = content
-                self.state = ParticipantStates.WAITING
-
-            return coordinator_response
-
-        elif type(content) == ResponseCode:
-            coordinator_send = self.send_response(content)
-            if not coordinator_send:
-                logger.warning("Unable to send response. Moving to WAITING.")
-                self.previous_edge_property = content
-                self.state = ParticipantStates.WAITING
-
-            return coordinator_send
+    def _tune_socket(self) -> None:
+        """ Tune a new socket for our small request / response messages. A socket keeps its options (and its timeout)
+        between messages, so we only do this when we are given a new socket. """
+        try:
+            self.socket.settimeout(self.failure_time)
+            if self.socket_buffer_size is not None:  # Setting either buffer disables the kernel's autotuning of it.
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_buffer_size)
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_buffer_size)
+            self._quick_ack()
+        except OSError as e:  # The socket is already closed. This is caught before we next send.
+            logger.warning("Could not tune socket. %s", e)
+
+    def _quick_ack(self) -> None:
+        """ Acknowledge the coordinator's segments immediately instead of delaying our ACK. The kernel may drop back to
+        delayed ACKs at any point, so this must be re-armed after each read. """
+        if _TCP_QUICKACK is not None:
+            try:
+                self.socket.setsockopt(socket.IPPROTO_TCP, _TCP_QUICKACK, 1)
+            except OSError:
+                pass  # Not a TCP socket, or the socket has been closed. Either way, there is nothing to ACK.
 
-        else:
-            logger.error("Content must be either an OpCode or a ResponseCode.")
-            raise RuntimeError("Content must be either an OpCode or a ResponseCode.")
+    def _read_message_quickack(self):
+        client_message = self.read_message()
+        self._quick_ack()
+        return client_message
+
+    def _send_op_edge(self, op_code: OpCode) -> Any:
+        """ Ask the coordinator something, and return its reply. On failure, we move to WAITING and return None. """
+        self.previous_edge_property = op_code
+        if self.socket.fileno() == -1:  # Our socket is closed, there is no point in attempting to send anything.
+            logger.warning("Socket has been closed. Unable to send %s.", op_code)
+            return None
+
+        if not self.send_op(op_code):
+            logger.warning("Unable to send request for transaction status. Moving to WAITING.")
+            self.state = ParticipantStates.WAITING
+            return None
+
+        coordinator_response = self.read_message()
+        if coordinator_response is None:
+            logger.warning("No reply from the coordinator about transaction status. Moving to WAITING.")
+            self.state = ParticipantStates.WAITING
+
+        return coordinator_response
+
+    def _send_response_edge(self, response_code: ResponseCode) -> bool:
+        """ Send a response to the coordinator. On failure, we move to WAITING and return False. """
+        self.previous_edge_property = response_code
+        if self.socket.fileno() == -1:
+            logger.warning("Socket has been closed. Unable to send %s.", response_code)
+            return False
+
+        if not self.send_response(response_code):
+            logger.warning("Unable to send response. Moving to WAITING.")
+            self.state = ParticipantStates.WAITING
+            return False
+
+        return True
+
+    def _finalize(self):
+        """ Move to the FINISHED state. Our resources are released as we exit, in _release. """
+        self.state = ParticipantStates.FINISHED
+
+    def _release(self):
+        """ Release our resources, however we have exited. Our RM connection always goes back to the pool, as the pool
+        is shared and capped. A connection we did not finish with (e.g. an exception left it mid-transaction, or it was
+        dropped) is closed instead of being handed to another thread. """
+        self.close()
+        self.protocol_db.close()
+        if not self.conn.closed:
+            self.cur.close()
+        self.rm_pool.putconn(self.conn, close=bool(self.conn.closed) or self.state != ParticipantStates.FINISHED)
 
     def _initialize_state(self):
-        logger.info(f"New transaction started: {self.transaction_id}.")
-        self.protocol_db.log_initialize_of(str(self.transaction_id), TransactionRole.PARTICIPANT)
-        self.protocol_db.add_coordinator(str(self.transaction_id), self.transaction_coordinator)
+        logger.info("New transaction started: %s.", self.transaction_id_str)
+
+        # Until we PREPARE, our RM will discard our work on failure. These only need to be durable before our vote.
+        with self.protocol_db.batch(is_blocking=False) as self.initialize_request:
+            self.protocol_db.log_initialize_of(self.transaction_id_str, TransactionRole.PARTICIPANT)
+            self.protocol_db.add_coordinator(self.transaction_id_str, self.transaction_coordinator)
         self.state = ParticipantStates.ACTIVE
 
     def _active_state(self):
-        client_message = self.read_message()
+        client_message = self._read_message_quickack()
         if client_message is None:
             logger.warning("Socket error occurred while waiting / reading message. Moving to ABORT state.")
             self.state = ParticipantStates.ABORT
             return
 
-        requested_op = client_message[0]
-        if requested_op == OpCode.INSERT_FROM_COORDINATOR:
-            # We have been issued an INSERT from our coordinator.
-            statement = client_message[1]
-            if not self._execute_statement(statement):
-                logger.warning("Statement was not successfully executed. Moving to ABORT state.")
-                self.state = ParticipantStates.ABORT
+        handler = self._ACTIVE_HANDLERS.get(client_message[0])
+        if handler is not None:
+            handler(self, client_message)
+        else:
+            logger.warning('Unknown operation received. Ignoring. %s', client_message)
 
-        elif requested_op == OpCode.PREPARE_TO_COMMIT:
-            # We have been asked to prepare to commit. Send the PREPARE to our RM.
-            try:
-                logger.info("Sending PREPARE to RM.")
-                self.conn.tpc_prepare()
+    def _handle_insert(self, client_message):
+        # We have been issued an INSERT from our coordinator.
+        statement = client_message[1]
+        if not self._execute_statement(statement):
+            logger.warning("Statement was not successfully executed. Moving to ABORT state.")
+            self.state = ParticipantStates.ABORT
+
+    def _handle_prepare(self, client_message):
+        # We have been asked to prepare to commit. Send the PREPARE to our RM.
+        try:
+            if self.initialize_request is not None:  # Recovery needs to know who our coordinator is.
+                self.initialize_request.wait()
 
-                logger.info("RM has approved of PREPARE. Sending PREPARED back, and moving to PREPARE state.")
-                self.send_response(ResponseCode.PREPARED_FROM_PARTICIPANT)  # Ignore error here!
-                self.state = ParticipantStates.PREPARED
-                self.is_prepared = True
+            logger.info("Sending PREPARE to RM.")
+            self.conn.tpc_prepare()
+            self.protocol_db.log_prepare_of(self.transaction_id_str)  # This must be durable before our vote.
 
-            except Exception as e:
-                logger.warning(f"RM could not PREPARE. Sending ABORT back, and moving to ABORT. {e}")
-                self.send_response(ResponseCode.ABORT_FROM_PARTICIPANT)  # Ignore error here!
-                self.state = ParticipantStates.ABORT
+            logger.info("RM has approved of PREPARE. Sending PREPARED back, and moving to PREPARE state.")
+            self.send_response(ResponseCode.PREPARED_FROM_PARTICIPANT)  # Ignore error here!
+            self.state = ParticipantStates.PREPARED
+            self.is_prepared = True
 
-        elif requested_op == OpCode.ROLLBACK_FROM_COORDINATOR:
-            # We have been asked to ABORT. Move to the ABORT state.
+        except Exception as e:
+            logger.warning("RM could not PREPARE. Sending ABORT back, and moving to ABORT. %s", e)
+            self.send_response(ResponseCode.ABORT_FROM_PARTICIPANT)  # Ignore error here!
             self.state = ParticipantStates.ABORT
 
-        else:
-            logger.warning(f'Unknown operation received. Ignoring. {client_message}')
+    def _handle_rollback(self, client_message):
+        # We have been asked to ABORT. Move to the ABORT state.
+        self.state = ParticipantStates.ABORT
+
+    # In the ACTIVE state, each op from our coordinator is handled with a single lookup.
+    _ACTIVE_HANDLERS = {
+        OpCode.INSERT_FROM_COORDINATOR: _handle_insert,
+        OpCode.PREPARE_TO_COMMIT: _handle_prepare,
+        OpCode.ROLLBACK_FROM_COORDINATOR: _handle_rollback
+    }
 
     def _prepared_state(self):
-        client_message = self.read_message()
+        client_message = self._read_message_quickack()
         if client_message is None:
             logger.warning("Socket error occurred while waiting / reading message. Moving to WAITING state.")
             self.previous_edge_property = OpCode.TRANSACTION_STATUS
             self.state = ParticipantStates.WAITING
             return
 
-        requested_op = client_message[0]
-        if requested_op == OpCode.COMMIT_FROM_COORDINATOR:
-            self.state = ParticipantStates.COMMIT
-        elif requested_op == OpCode.ROLLBACK_FROM_COORDINATOR:
-            self.state = ParticipantStates.ABORT
+        next_state = _PREPARED_NEXT_STATES.get(client_message[0])
+        if next_state is not None:
+            self.state = next_state
         else:
-            logger.warning(f'Unknown operation received. Ignoring. {client_message}')
+            logger.warning('Unknown operation received. Ignoring. %s', client_message)
 
-    def _abort_state(self):
-        if self.is_prepared:  # We only rollback if we were prepared in the first place.
-            logger.info("Sending ROLLBACK to RM.")
-            self.conn.tpc_rollback()
-            self.protocol_db.log_abort_of(str(self.transaction_id))
-
-        if not self._send_edge(ResponseCode.ACKNOWLEDGE_END):
+    def _acknowledge_end(self):
+        """ Acknowledge the end of our transaction to our coordinator. Both ABORT and COMMIT finish through here. """
+        if not self._send_response_edge(ResponseCode.ACKNOWLEDGE_END):
             logger.warning("Unable to send acknowledgement to coordinator. Moving to WAITING.")
             self.state = ParticipantStates.WAITING
 
         else:
-            self.close()  # Release our resources.
-            self.conn.close()
-            self.protocol_db.close()
-            self.state = ParticipantStates.FINISHED
+            self._finalize()
+
+    def _abort_state(self):
+        # Every path to ABORT (a failed INSERT, a failed PREPARE, or a ROLLBACK from our coordinator) ends here. Our
+        # unprepared work is discarded too, so the connection can be returned to the pool.
+        logger.info("Sending ROLLBACK to RM.")
+        self.conn.tpc_rollback()
+        if self.is_prepared:  # We only log our abort if we were prepared in the first place.
+            self.protocol_db.log_abort_of(self.transaction_id_str)
+
+        self._acknowledge_end()
 
     def _commit_state(self):
         logger.info("Logging COMMIT and sending COMMIT to local RM. Sending ACK to coordinator.")
         self.conn.tpc_commit()
-        self.protocol_db.log_commit_of(str(self.transaction_id))
 
-        if not self._send_edge(ResponseCode.ACKNOWLEDGE_END):
-            logger.warning("Unable to send acknowledgement to coordinator. Moving to WAITING.")
-            self.state = ParticipantStates.WAITING
-
-        else:
-            self.close()  # Release our resources.
-            self.conn.close()
-            self.protocol_db.close()
-            self.state = ParticipantStates.FINISHED
+        # Our durable PREPARE record already covers recovery, so we do not wait for our commit record to be flushed.
+        self.protocol_db.log_commit_of(self.transaction_id_str, is_blocking=False)
+        self._acknowledge_end()
 
     def _waiting_state(self):
-        self.socket.close()  # We assume this socket to be dead.
-        self.socket_token.get()
+        with self.socket_lock:  # We assume our socket to be dead, unless a new one was injected before we got here.
+            if not self.socket_injected.is_set():
+                self.socket.close()
+
+        self.socket_injected.wait()
+        self.socket_injected.clear()
         logger.info("Moving out of the WAITING state.")
-        self.socket_token.task_done()
 
         # Repeat the action which lead us to the WAITING state.
-        coordinator_response = self._send_edge(self.previous_edge_property)
+        is_response = self.previous_edge_property.__class__ is ResponseCode
+        coordinator_response = self._send_response_edge(self.previous_edge_property) if is_response \
+            else self._send_op_edge(self.previous_edge_property)
         if coordinator_response is None or not coordinator_response:
-            logger.warning(f"Unable to send the message {self.previous_edge_property}. Staying in WAITING state.")
+            logger.warning("Unable to send the message %s. Staying in WAITING state.", self.previous_edge_property)
             pass  # We have failed in the WAITING state. Looping back.
 
-        elif type(self.previous_edge_property) == ResponseCode and coordinator_response:
-            self.close()  # Release our resources.
-            self.conn.close()
-            self.protocol_db.close()
-            self.state = ParticipantStates.FINISHED
+        elif is_response:
+            self._finalize()
 
         else:
-            coordinator_code = coordinator_response[0]
-            if coordinator_code == OpCode.COMMIT_FROM_COORDINATOR or \
-                    coordinator_code == ResponseCode.TRANSACTION_COMMITTED:
-                self.state = ParticipantStates.COMMIT
-            elif coordinator_code == OpCode.ROLLBACK_FROM_COORDINATOR or \
-                    coordinator_code == ResponseCode.TRANSACTION_ABORTED:
-                self.state = ParticipantStates.ABORT
+            next_state = _WAITING_NEXT_STATES.get(coordinator_response[0])
+            if next_state is not None:
+                self.state = next_state
             else:
-                logger.error(f"Unknown response received from coordinator: {coordinator_response}.")
+                logger.error("Unknown response received from coordinator: %s.", coordinator_response)
 
     def _execute_statement(self, statement: str) -> bool:
         """ Execute the statement-- send the statement to the RM. If this fails, we return false."""
         try:
             # Execute the statement.
-            cur = self.conn.cursor()
-            cur.execute(statement)
+            self.cur.execute(_as_prepared_insert(self.cur, statement))
 
-            statement_no_newlines = statement.replace('\n', '')
-            logger.debug(f"{statement_no_newlines} successful.")
+            if logger.isEnabledFor(logging.DEBUG):  # Avoid copying the statement unless we are going to log it.
+                logger.debug("%s successful.", statement.replace('\n', ''))
             self.send_response(ResponseCode.OK)
             return True
 
         except psycopg2.IntegrityError as e:
-            logger.info(f"Integrity error caught. Exiting now: {e}")
+            logger.info("Integrity error caught. Exiting now: %s", e)
             return False
 
         except Exception as e:
-            logger.error(f"Unknown exception caught. Exiting now: {e}")
+            logger.error("Unknown exception caught. Exiting now: %s", e)
             return False
 
     def inject_socket(self, client_socket: socket.socket):
         """ Inject a new socket connection for our participant to use. """
-        logger.info(f"Injecting new socket to participant: {client_socket}.")
-        self.socket = client_socket
-        self.socket_token.put(b'')
+        logger.info("Injecting new socket to participant: %s.", client_socket)
+        with self.socket_lock:
+            if self.socket_injected.is_set():  # An earlier socket was never picked up, and has now been superseded.
+                self.socket.close()
+
+            self.socket = client_socket
+            self._tune_socket()
+            self.socket_injected.set()
+
+    # Handlers are indexed by the value of their state, so each hop is a single subscript instead of a walk down an
+    # if / elif chain. This must follow the order of ParticipantStates.
+    _STATE_HANDLERS = (
+        None,  # ParticipantStates.INITIALIZE, which is handled before we enter our loop.
+        _active_state,  # ParticipantStates.ACTIVE
+        _prepared_state,  # ParticipantStates.PREPARED
+        _abort_state,  # ParticipantStates.ABORT
+        _commit_state,  # ParticipantStates.COMMIT
+        _waiting_state  # ParticipantStates.WAITING
+    )
 
     def run(self) -> None:
-        while self.state != ParticipantStates.FINISHED:
+        try:
+            if self.participant_cpus:
+                _pin_to_cpu(self.participant_cpus)
+
+            # A new transaction passes through INITIALIZE exactly once. Recovered transactions start elsewhere, as the
+            # state is only known after instantiation (hence we do not do this in __init__).
             if self.state == ParticipantStates.INITIALIZE:
                 logger.info("Moving to INITIALIZE state.")
                 self._initialize_state()
 
-            elif self.state == ParticipantStates.ACTIVE:
-                logger.debug("Moving to ACTIVE state.")
-                self._active_state()
-
-            elif self.state == ParticipantStates.PREPARED:
-                logger.info("Moving to PREPARED state.")
-                self._prepared_state()
-
-            elif self.state == ParticipantStates.ABORT:
-                logger.info("Moving to ABORT state.")
-                self._abort_state()
-
-            elif self.state == ParticipantStates.COMMIT:
-                logger.info("Moving to COMMIT state.")
-                self._commit_state()
+            while self.state != ParticipantStates.FINISHED:
+                # We move through the ACTIVE state once per statement, so we do not log this at INFO.
+                logger.log(logging.DEBUG if self.state == ParticipantStates.ACTIVE else logging.INFO,
+                           "Moving to %s state.", self.state.name)
+                self._STATE_HANDLERS[self.state](self)
 
-            elif self.state == ParticipantStates.WAITING:
-                logger.info("Moving to WAITING state.")
-                self._waiting_state()
+            logger.info("Moving to FINISHED state. Exiting thread.")
 
-        logger.info("Moving to FINISHED state. Exiting thread.")
+        finally:
+            self._release()
@@ -1,176 +1,358 @@
 """ This file holds all protocol-DB related functionality. """
+import contextlib
+import itertools
+import threading
 import sqlite3
 import logging
+import queue
+import time
 
-from typing import List
+from typing import Iterable, List, Tuple
 from shared import *
 
 # We maintain a module-level logger.
 logger = logging.getLogger(__name__)
 
+# Our SQL is kept as module-level constants. Every write of the same kind then hands the same string to SQLite, which
+# finds the string in its statement cache instead of parsing it again (and lets our group committer coalesce runs).
+_INSERT_STATE_SQL = """
+    INSERT INTO STATE_LOG (tr_id, state)
+    VALUES (?, ?);
+"""
+_INSERT_ROLE_SQL = """
+    INSERT INTO TRANSACTION_LOG (tr_id, tr_role)
+    VALUES (?, ?);
+"""
+_INSERT_SITE_SQL = """
+    INSERT INTO TRANSACTION_SITE_LOG (tr_id, tr_role, node_id)
+    VALUES (?, ?, ?);
+"""
+_UPSERT_STATUS_SQL = """
+    INSERT OR REPLACE INTO TRANSACTION_STATUS (tr_id, state)
+    VALUES (?, ?);
+"""
+_SELECT_TRANSACTIONS_IN_SQL = """
+    SELECT tr_id
+    FROM TRANSACTION_STATUS
+    WHERE state = ?;
+"""
+_SELECT_ROLE_SQL = """
+    SELECT tr_role
+    FROM TRANSACTION_LOG
+    WHERE tr_id = ?;
+"""
+_SELECT_SITES_SQL = """
+    SELECT node_id
+    FROM TRANSACTION_SITE_LOG
+    WHERE tr_id = ? AND tr_role = ?;
+"""
+
+
+def _connect(database_file: str) -> sqlite3.Connection:
+    """ Open a connection to the protocol database. In WAL mode, a commit is a single append to the write-ahead log
+    (instead of a journal write and a database write), and our recovery readers do not block our writers. We keep
+    synchronous at FULL: a PREPARE record must survive a power loss before we vote. Many threads open the same file,
+    so we wait on a locked database instead of failing outright. We begin our own (write) transactions, instead of
+    letting the sqlite3 module open one implicitly before each statement. """
+    conn = sqlite3.connect(database_file, check_same_thread=False, cached_statements=256, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = FULL;")
+    conn.execute("PRAGMA busy_timeout = 5000;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA mmap_size = 268435456;")  # Reads map the OS page cache, shared by all of our connections.
+    return conn
+
+
+def _execute_all(cur: sqlite3.Cursor, statements: Iterable[Tuple[str, Tuple]]) -> None:
+    """ Execute the given statements in order. Adjacent runs of the same statement are coalesced into one executemany,
+    which binds each set of parameters to a single prepared statement. """
+    for statement, group in itertools.groupby(statements, key=lambda s: s[0]):
+        cur.executemany(statement, [parameters for _, parameters in group])
+
+
+def _commit_all(cur: sqlite3.Cursor, statements: Iterable[Tuple[str, Tuple]]) -> None:
+    """ Execute and commit the given statements as one transaction, or none of them at all. We take the write lock up
+    front (instead of upgrading to it at our first write), so a reader can never force our transaction to retry. """
+    cur.execute("BEGIN IMMEDIATE;")
+    try:
+        _execute_all(cur, statements)
+        cur.execute("COMMIT;")
+
+    except BaseException:
+        cur.connection.rollback()
+        raise
+
+
+class _CommitRequest(object):
+    """ A group of statements that must become durable together, and the event its owner waits on. """
+    __slots__ = ('statements', 'is_durable', 'error')  # One of these is created for every write.
+
+    def __init__(self, statements: List[Tuple[str, Tuple]]):
+        self.statements = statements
+        self.is_durable = threading.Event()
+        self.error = None
+
+    def wait(self) -> None:
+        """ Block until our statements are durable. Raises the error the statements produced, if any. """
+        self.is_durable.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class GroupCommitter(threading.Thread):
+    """ Single writer per protocol database. Log records from many threads are committed (i.e. fsync-ed) together. """
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    # Past this many requests, waiting any longer only delays those already queued.
+    MAX_BATCH_SIZE = 64
+
+    def __init__(self, database_file: str, window: float):
+        threading.Thread.__init__(self, daemon=True)
+        self.conn = _connect(database_file)
+        self.cur = self.conn.cursor()
+        self.database_file = database_file
+        self.pending = queue.Queue()
+        self.window = window
+        self.users = 0
+
+    @staticmethod
+    def acquire(database_file: str, window: float) -> 'GroupCommitter':
+        """ Return the committer for the given file, starting one if this is the first user. """
+        with GroupCommitter._instances_lock:
+            if database_file not in GroupCommitter._instances:
+                GroupCommitter._instances[database_file] = GroupCommitter(database_file, window)
+                GroupCommitter._instances[database_file].start()
+
+            committer = GroupCommitter._instances[database_file]
+            committer.users += 1
+            return committer
+
+    def release(self) -> None:
+        """ Stop our committer (after all pending requests have been flushed) once the last user has left. """
+        with GroupCommitter._instances_lock:
+            self.users -= 1
+            if self.users == 0:
+                GroupCommitter._instances.pop(self.database_file)
+                self.pending.put(None)
+
+    def submit(self, request: _CommitRequest) -> None:
+        """ Queue the given request for the next batch. Call wait() on the request to block until durable. """
+        self.pending.put(request)
+
+    def _commit(self, batch: List[_CommitRequest]) -> None:
+        try:  # In the common case, the entire batch is committed together.
+            _commit_all(self.cur, (s for request in batch for s in request.statements))
+
+        except Exception as e:  # Otherwise, isolate the failure by committing each request on its own.
+            logger.warning("Could not commit batch of %s requests. Committing individually. %s", len(batch), e)
+            for request in batch:
+                try:
+                    _commit_all(self.cur, request.statements)
+
+                except Exception as e:
+                    logger.error("Could not commit log request %s. %s", request.statements, e)
+                    request.error = e
+
+        for request in batch:
+            request.is_durable.set()
+
+    def run(self) -> None:
+        is_running = True
+        while is_running:
+            batch = [self.pending.get()]  # Wait for the first request, then give others a window to join it.
+            window_end = time.monotonic() + self.window
+            while len(batch) < GroupCommitter.MAX_BATCH_SIZE:  # A full batch is flushed without waiting out the window.
+                try:
+                    batch.append(self.pending.get(timeout=max(window_end - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            if None in batch:  # We have been released. Flush what we have, then exit.
+                batch = [request for request in batch if request is not None]
+                is_running = False
+
+            logger.debug("Committing %s log requests with a single transaction.", len(batch))
+            self._commit(batch)
+
+        self.cur.close()
+        self.conn.close()
+
 
 class ProtocolDatabase(object):
     def _create_tables(self) -> None:
-        cur = self.conn.cursor()
-        cur.execute("""
+        self.cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'TRANSACTION_STATUS';")
+        is_status_new = self.cur.fetchone() is None
+
+        # This runs for every new participant / coordinator, so we hand all of our DDL to SQLite in one call.
+        self.cur.executescript("""
             CREATE TABLE IF NOT EXISTS TRANSACTION_LOG (
                 tr_id TEXT PRIMARY KEY,
                 tr_role INT
             );
-        """)
-        cur.execute("""
             CREATE TABLE IF NOT EXISTS TRANSACTION_SITE_LOG (
                 tr_id TEXT,
                 tr_role INT,
                 node_id INT
             );
-        """)
-        cur.execute(""" -- This is append-only. --
+            CREATE INDEX IF NOT EXISTS TRANSACTION_SITE_LOG_ID ON TRANSACTION_SITE_LOG (tr_id, tr_role);
+            -- This is append-only. --
             CREATE TABLE IF NOT EXISTS STATE_LOG (
                 tr_id TEXT, 
                 state TEXT
             );
+            -- The most recent state of each transaction, kept alongside our state log. --
+            CREATE TABLE IF NOT EXISTS TRANSACTION_STATUS (
+                tr_id TEXT PRIMARY KEY,
+                state TEXT
+            );
+            CREATE INDEX IF NOT EXISTS TRANSACTION_STATUS_STATE ON TRANSACTION_STATUS (state);
         """)
 
-    def __init__(self, database_file: str):
-        self.conn = sqlite3.connect(database_file, check_same_thread=False)
+        if is_status_new:  # Protocol databases from before TRANSACTION_STATUS existed are brought up to date once.
+            self.cur.execute("""
+                INSERT OR IGNORE INTO TRANSACTION_STATUS (tr_id, state)
+                SELECT tr_id, state
+                FROM (SELECT tr_id, state, MAX(rowid) FROM STATE_LOG GROUP BY tr_id);
+            """)
+
+    def __init__(self, database_file: str, group_commit_window: float = None):
+        self.conn = _connect(database_file)
+        self.cur = self.conn.cursor()  # All of our statements are executed through this one cursor.
         self._create_tables()
 
-    def log_initialize_of(self, transaction_id: str, role: TransactionRole) -> None:
-        logger.info(f"Transaction {transaction_id} has been initialized with role {role}.")
-        cur = self.conn.cursor()
-        cur.execute("""
-            INSERT INTO STATE_LOG (tr_id, state)
-            VALUES (?, "I");
-        """, (transaction_id,))
-        cur.execute("""
-            INSERT INTO TRANSACTION_LOG (tr_id, tr_role)
-            VALUES (?, ?);
-        """, (transaction_id, 0 if role == TransactionRole.PARTICIPANT else 1,))
-        self.conn.commit()
+        # If a window is given, our commit records are flushed alongside those of other threads.
+        self.group_committer = GroupCommitter.acquire(database_file, group_commit_window) \
+            if group_commit_window is not None else None
+        self.current_batch = None
+
+    def _submit(self, request: _CommitRequest, is_blocking: bool) -> None:
+        """ Commit the statements of the given request together. With a group committer, our statements are flushed
+        alongside those of other threads. """
+        if self.group_committer is not None:
+            self.group_committer.submit(request)
+            if is_blocking:
+                request.wait()
+            return
+
+        _commit_all(self.cur, request.statements)
+        request.is_durable.set()
+
+    def _write(self, statements: List[Tuple[str, Tuple]], is_blocking: bool = True) -> _CommitRequest:
+        """ Commit the given statements together. If not blocking, the caller can wait() on the result later (or
+        never). Within a batch, our statements are held back until the batch is committed. """
+        if self.current_batch is not None:
+            self.current_batch.statements.extend(statements)
+            return self.current_batch
+
+        request = _CommitRequest(statements)
+        self._submit(request, is_blocking)
+        return request
+
+    @contextlib.contextmanager
+    def batch(self, is_blocking: bool = True):
+        """ Commit every write made within this block with a single commit, once the block exits. Each write returns
+        (and this yields) the request of the entire batch. If the block raises, none of its writes are committed. """
+        self.current_batch = _CommitRequest([])
+        try:
+            yield self.current_batch
+
+        except BaseException as e:
+            self.current_batch.error = e  # Anyone waiting on our batch must not block forever.
+            self.current_batch.is_durable.set()
+            raise
+
+        finally:
+            request, self.current_batch = self.current_batch, None
+
+        self._submit(request, is_blocking)
+
+    def log_initialize_of(self, transaction_id: str, role: TransactionRole,
+                          is_blocking: bool = True) -> _CommitRequest:
+        logger.info("Transaction %s has been initialized with role %s.", transaction_id, role)
+        return self._write([
+            (_INSERT_STATE_SQL, (transaction_id, "I",)),
+            (_UPSERT_STATUS_SQL, (transaction_id, "I",)),
+            (_INSERT_ROLE_SQL, (transaction_id, int(role),))  # Our roles are stored by value (participant is 0).
+        ], is_blocking)
 
     def add_participant(self, transaction_id: str, node_id: int) -> None:
-        logger.info(f"Adding participant {node_id} to transaction {transaction_id}.")
-        cur = self.conn.cursor()
-        cur.execute("""
-            INSERT INTO TRANSACTION_SITE_LOG (tr_id, tr_role, node_id)
-            VALUES (?, 0, ?);
-        """, (transaction_id, node_id,))
-        self.conn.commit()
-
-    def add_coordinator(self, transaction_id: str, node_id: int) -> None:
-        logger.info(f"Adding coordinator {node_id} to transaction {transaction_id}.")
-        cur = self.conn.cursor()
-        cur.execute("""
-            INSERT INTO TRANSACTION_SITE_LOG (tr_id, tr_role, node_id)
-            VALUES (?, 1, ?);
-        """, (transaction_id, node_id,))
-        self.conn.commit()
+        self.add_participants(transaction_id, [node_id])
+
+    def add_participants(self, transaction_id: str, node_ids: List[int]) -> None:
+        """ Record all of the given participants with a single commit. """
+        logger.info("Adding participants %s to transaction %s.", node_ids, transaction_id)
+        self._write([(_INSERT_SITE_SQL, (transaction_id, 0, node_id,)) for node_id in node_ids])
+
+    def add_coordinator(self, transaction_id: str, node_id: int, is_blocking: bool = True) -> _CommitRequest:
+        logger.info("Adding coordinator %s to transaction %s.", node_id, transaction_id)
+        return self._write([(_INSERT_SITE_SQL, (transaction_id, 1, node_id,))], is_blocking)
+
+    def _get_transactions_in(self, state: str) -> List[str]:
+        """ Find the transactions whose most recent state is the one given. This is an index lookup on our status
+        table (instead of a scan of our ever-growing state log), and we stream the matches from the cursor. """
+        self.cur.execute(_SELECT_TRANSACTIONS_IN_SQL, (state,))
+        return [i[0] for i in self.cur]
 
     def get_abortable_transactions(self) -> List[str]:
-        cur = self.conn.cursor()
-        cur.execute("""
-            SELECT tr_id, GROUP_CONCAT(state)
-            FROM STATE_LOG
-            GROUP BY tr_id 
-            HAVING GROUP_CONCAT(state) NOT LIKE "%C" AND 
-                   GROUP_CONCAT(state) NOT LIKE "%P" AND 
-                   GROUP_CONCAT(state) NOT LIKE "%A";
-        """)
-        return [i[0] for i in cur.fetchall()]
+        return self._get_transactions_in("I")
 
     def get_prepared_transactions(self) -> List[str]:
-        cur = self.conn.cursor()
-        cur.execute("""
-            SELECT tr_id, GROUP_CONCAT(state)
-            FROM STATE_LOG
-            GROUP BY tr_id 
-            HAVING GROUP_CONCAT(state) NOT LIKE "%C" AND 
-                   GROUP_CONCAT(state) NOT LIKE "%I" AND 
-                   GROUP_CONCAT(state) NOT LIKE "%A";
-        """)
-        return [i[0] for i in cur.fetchall()]
+        return self._get_transactions_in("P")
 
     def get_role_in(self, transaction_id: str) -> TransactionRole:
-        cur = self.conn.cursor()
-        cur.execute("""
-            SELECT tr_role
-            FROM TRANSACTION_LOG
-            WHERE tr_id = ?;
-        """, (transaction_id,))
-
-        result_set = cur.fetchone()
-        if len(result_set) <= 0:
-            logger.fatal(f"Error: Transaction {transaction_id} does not exist in the protocol database.")
+        self.cur.execute(_SELECT_ROLE_SQL, (transaction_id,))
+
+        result_set = self.cur.fetchone()
+        if result_set is None:
+            logger.fatal("Error: Transaction %s does not exist in the protocol database.", transaction_id)
             raise SystemError(f"Error: Transaction {transaction_id} does not exist in the protocol database.")
 
-        elif result_set[0] == 0:
-            logger.info(f"Role in transaction {transaction_id} is participant.")
-            return TransactionRole.PARTICIPANT
-        else:
-            logger.info(f"Role in transaction {transaction_id} is coordinator.")
-            return TransactionRole.COORDINATOR
+        role = TransactionRole(result_set[0])  # Our roles are stored by value.
+        logger.info("Role in transaction %s is %s.", transaction_id, role)
+        return role
 
     def get_participants_in(self, transaction_id: str) -> List[int]:
-        cur = self.conn.cursor()
-        cur.execute("""
-            SELECT node_id
-            FROM TRANSACTION_SITE_LOG
-            WHERE tr_id = ? AND tr_role = 0;
-        """, (transaction_id,))
-        return [i[0] for i in cur.fetchall()]
+        self.cur.execute(_SELECT_SITES_SQL, (transaction_id, 0,))
+        return [i[0] for i in self.cur]
 
     def get_coordinator_for(self, transaction_id: str) -> int:
-        cur = self.conn.cursor()
-        cur.execute("""
-            SELECT node_id
-            FROM TRANSACTION_SITE_LOG
-            WHERE tr_id = ? AND tr_role = 1;
-        """, (transaction_id,))
-
-        result_set = cur.fetchall()
-        if len(result_set) < 1:
-            logger.fatal(f"Error: Transaction {transaction_id} does not exist in the protocol database.")
+        self.cur.execute(_SELECT_SITES_SQL, (transaction_id, 1,))
+
+        result_set = self.cur.fetchone()
+        if result_set is None:
+            logger.fatal("Error: Transaction %s does not exist in the protocol database.", transaction_id)
             raise SystemError(f"Error: Transaction {transaction_id} does not exist in the database.")
 
-        return result_set[0][0]
-
-    def log_prepare_of(self, transaction_id: str):
-        logger.info(f"Transaction {transaction_id} has been prepared.")
-        cur = self.conn.cursor()
-        cur.execute("""
-            INSERT INTO STATE_LOG (tr_id, state)
-            VALUES (?, "P");
-        """, (transaction_id,))
-        self.conn.commit()
-
-    def log_commit_of(self, transaction_id: str):
-        logger.info(f"Transaction {transaction_id} has been committed.")
-        cur = self.conn.cursor()
-        cur.execute("""
-            INSERT INTO STATE_LOG (tr_id, state)
-            VALUES (?, "C");
-        """, (transaction_id,))
-        self.conn.commit()
-
-    def log_abort_of(self, transaction_id: str):
-        logger.info(f"Transaction {transaction_id} has been aborted.")
-        cur = self.conn.cursor()
-        cur.execute("""
-            INSERT INTO STATE_LOG (tr_id, state)
-            VALUES (?, "A");
-        """, (transaction_id,))
-        self.conn.commit()
-
-    def log_completion_of(self, transaction_id: str):
-        logger.info(f"Transaction {transaction_id} has been completed.")
-        cur = self.conn.cursor()
-        cur.execute("""
-            INSERT INTO STATE_LOG (tr_id, state)
-            VALUES (?, "D");
-        """, (transaction_id,))
-        self.conn.commit()
+        return result_set[0]
+
+    def _log_state_of(self, transaction_id: str, state: str, is_blocking: bool) -> _CommitRequest:
+        """ Append to our state log (and record this as the most recent state of our transaction). If not blocking, the
+        caller can wait() on the result later (or never). """
+        return self._write([
+            (_INSERT_STATE_SQL, (transaction_id, state,)),
+            (_UPSERT_STATUS_SQL, (transaction_id, state,))
+        ], is_blocking)
+
+    def log_prepare_of(self, transaction_id: str, is_blocking: bool = True) -> _CommitRequest:
+        logger.info("Transaction %s has been prepared.", transaction_id)
+        return self._log_state_of(transaction_id, "P", is_blocking)
+
+    def log_commit_of(self, transaction_id: str, is_blocking: bool = True) -> _CommitRequest:
+        logger.info("Transaction %s has been committed.", transaction_id)
+        return self._log_state_of(transaction_id, "C", is_blocking)
+
+    def log_abort_of(self, transaction_id: str, is_blocking: bool = True) -> _CommitRequest:
+        logger.info("Transaction %s has been aborted.", transaction_id)
+        return self._log_state_of(transaction_id, "A", is_blocking)
+
+    def log_completion_of(self, transaction_id: str, is_blocking: bool = True) -> _CommitRequest:
+        logger.info("Transaction %s has been completed.", transaction_id)
+        return self._log_state_of(transaction_id, "D", is_blocking)
 
     def close(self):
-        self.conn.commit()
+        if self.group_committer is not None:
+            self.group_committer.release()
+
+        self.cur.close()
         self.conn.close()
@@ -0,0 +1,35 @@
+""" This file holds all resource manager (i.e. Postgres) connection related functionality. """
+import psycopg2.pool
+import threading
+import logging
+
+# We maintain a module-level logger.
+logger = logging.getLogger(__name__)
+
+# All coordinators and participants borrow their RM connections from one pool. The daemon creates this on startup,
+# otherwise the first user does. On return, the pool rolls back any (one-phase) transaction still open on a connection.
+# Two-phase transactions must be resolved (i.e. committed or rolled back) before a connection is returned.
+_postgres_pool = None
+_postgres_pool_lock = threading.Lock()
+
+# Raised by getconn() once every connection of our pool has been borrowed. Callers must reject their transaction.
+PoolError = psycopg2.pool.PoolError
+
+
+def get_postgres_pool(**context) -> psycopg2.pool.ThreadedConnectionPool:
+    """ Return the RM connection pool shared by all coordinators and participants, creating it on first use. """
+    global _postgres_pool
+
+    with _postgres_pool_lock:
+        if _postgres_pool is None:
+            logger.info("Creating RM connection pool.")
+            _postgres_pool = psycopg2.pool.ThreadedConnectionPool(
+                minconn=1,
+                maxconn=context.get('postgres_pool_size', 100),
+                user=context['postgres_username'],
+                password=context['postgres_password'],
+                host=context['postgres_hostname'],
+                database=context['postgres_database']
+            )
+
+        return _postgres_pool
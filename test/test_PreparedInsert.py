@@ -0,0 +1,87 @@
+import participate
+import unittest
+import logging
+
+# We maintain a module-level logger.
+logger = logging.getLogger(__name__)
+
+
+class TestPreparedInsert(unittest.TestCase):
+    """ Verifies the rewrite of the coordinator's INSERTs into EXECUTEs of prepared statements. """
+
+    class _TestConnection:
+        pass
+
+    class _TestCursor:
+        def __init__(self, connection):
+            self.connection = connection
+            self.statements = []
+
+        def execute(self, statement):
+            self.statements.append(statement)
+
+    def setUp(self) -> None:
+        self.cur = self._TestCursor(self._TestConnection())
+
+    def test_rewrite(self):
+        statement = "insert into observation values ('a''b', 1, -2.5, +3e2);"
+        self.assertEqual(participate._as_prepared_insert(self.cur, statement),
+                         "EXECUTE ins_observation_4('a''b', 1, -2.5, +3e2)")
+        self.assertEqual(self.cur.statements, ['PREPARE ins_observation_4 AS INSERT INTO observation '
+                                               'VALUES ($1, $2, $3, $4)'])
+
+        # Our statement is only prepared once per connection.
+        statement = "INSERT INTO observation VALUES ('c', 2, 3.5, 'd')"
+        self.assertEqual(participate._as_prepared_insert(self.cur, statement),
+                         "EXECUTE ins_observation_4('c', 2, 3.5, 'd')")
+        self.assertEqual(len(self.cur.statements), 1)
+
+        other_cur = self._TestCursor(self._TestConnection())
+        participate._as_prepared_insert(other_cur, statement)
+        self.assertEqual(len(other_cur.statements), 1)
+
+    def test_fallback(self):
+        statements = [
+            "insert into observation values (1, 'a'), (2, 'b');",
+            "insert into observation (id, name) values (1, 'a');",
+            "insert into observation values (1, now());",
+            "insert into observation values (1, E'a\\nb');",
+            "insert into observation values (1, DEFAULT);",
+            "insert into observation values (1, NULL);",
+            "insert into observation values (1, true);",
+            "insert into observation values (1, sensor_id);",
+            "insert into observation values ();",
+            "delete from observation where id = 1;"
+        ]
+        for statement in statements:
+            self.assertEqual(participate._as_prepared_insert(self.cur, statement), statement)
+        self.assertEqual(self.cur.statements, [])
+
+    def test_eviction(self):
+        for i in range(participate._MAX_PREPARED_INSERTS):
+            participate._as_prepared_insert(self.cur, f"insert into observation_{i} values (1);")
+        self.assertEqual(len(self.cur.statements), participate._MAX_PREPARED_INSERTS)
+
+        # Using our first statement again makes the second our least recently used.
+        participate._as_prepared_insert(self.cur, "insert into observation_0 values (2);")
+        self.assertEqual(len(self.cur.statements), participate._MAX_PREPARED_INSERTS)
+
+        self.cur.statements.clear()
+        self.assertEqual(participate._as_prepared_insert(self.cur, "insert into observation values (1);"),
+                         "EXECUTE ins_observation_1(1)")
+        self.assertEqual(self.cur.statements, ['DEALLOCATE ins_observation_1_1',
+                                               'PREPARE ins_observation_1 AS INSERT INTO observation VALUES ($1)'])
+
+        # Our evicted statement must be prepared again.
+        self.cur.statements.clear()
+        participate._as_prepared_insert(self.cur, "insert into observation_1 values (1);")
+        self.assertEqual(self.cur.statements, ['DEALLOCATE ins_observation_2_1',
+                                               'PREPARE ins_observation_1_1 AS INSERT INTO observation_1 '
+                                               'VALUES ($1)'])
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(stream=sys.stderr)
+    unittest.main()
@@ -1,5 +1,7 @@
+import threading
 import unittest
 import protocol
+import sqlite3
 import logging
 import uuid
 import time
@@ -16,15 +18,16 @@ class TestProtocolDatabase(unittest.TestCase):
     test_file = 'test_database.log'
 
     def tearDown(self) -> None:
-        try:
-            os.remove('coordinator_' + self.test_file)
-        except OSError:
-            pass
+        for suffix in ['', '-wal', '-shm']:
+            try:
+                os.remove('coordinator_' + self.test_file + suffix)
+            except OSError:
+                pass
 
-        try:
-            os.remove('participant_' + self.test_file)
-        except OSError:
-            pass
+            try:
+                os.remove('participant_' + self.test_file + suffix)
+            except OSError:
+                pass
 
     @staticmethod
     def _strip_whitespace(text):
@@ -90,6 +93,31 @@ class TestProtocolDatabase(unittest.TestCase):
         participant_pdb.close()
         time.sleep(0.5)
 
+    def test_bulk_site_awareness(self):
+        transaction_id = str(uuid.uuid4())
+
+        coordinator_pdb = protocol.ProtocolDatabase('coordinator_' + self.test_file)
+        coordinator_pdb.log_initialize_of(transaction_id, TransactionRole.COORDINATOR)
+        coordinator_pdb.add_participants(transaction_id, [1, 2, 3])
+
+        participants = coordinator_pdb.get_participants_in(transaction_id)
+        self.assertEqual(sorted(participants), [1, 2, 3])
+
+        coordinator_pdb.close()
+        time.sleep(0.5)
+
+    def test_unknown_transaction(self):
+        transaction_id = str(uuid.uuid4())
+
+        participant_pdb = protocol.ProtocolDatabase('participant_' + self.test_file)
+        with self.assertRaises(SystemError):
+            participant_pdb.get_role_in(transaction_id)
+        with self.assertRaises(SystemError):
+            participant_pdb.get_coordinator_for(transaction_id)
+
+        participant_pdb.close()
+        time.sleep(0.5)
+
     def test_transaction_recovery(self):
         transaction_id_1 = str(uuid.uuid4())
         transaction_id_2 = str(uuid.uuid4())
@@ -109,6 +137,109 @@ class TestProtocolDatabase(unittest.TestCase):
         coordinator_pdb.close()
         time.sleep(0.5)
 
+    def test_superseded_states(self):
+        transaction_id_1 = str(uuid.uuid4())
+        transaction_id_2 = str(uuid.uuid4())
+
+        coordinator_pdb = protocol.ProtocolDatabase('coordinator_' + self.test_file)
+        coordinator_pdb.log_initialize_of(transaction_id_1, TransactionRole.COORDINATOR)
+        coordinator_pdb.log_initialize_of(transaction_id_2, TransactionRole.COORDINATOR)
+        coordinator_pdb.log_prepare_of(transaction_id_1)
+        coordinator_pdb.log_commit_of(transaction_id_1)
+        coordinator_pdb.log_completion_of(transaction_id_1)
+        coordinator_pdb.log_prepare_of(transaction_id_2)
+
+        abortable_transactions = coordinator_pdb.get_abortable_transactions()
+        prepared_transactions = coordinator_pdb.get_prepared_transactions()
+        self.assertEqual(len(abortable_transactions), 0)
+        self.assertEqual(len(prepared_transactions), 1)
+        self.assertEqual(prepared_transactions[0], transaction_id_2)
+
+        coordinator_pdb.close()
+        time.sleep(0.5)
+
+    def test_group_commit(self):
+        transaction_ids = [str(uuid.uuid4()) for _ in range(10)]
+
+        participant_pdbs = [protocol.ProtocolDatabase('participant_' + self.test_file, 0.01) for _ in transaction_ids]
+        for transaction_id, participant_pdb in zip(transaction_ids, participant_pdbs):
+            participant_pdb.log_initialize_of(transaction_id, TransactionRole.PARTICIPANT)
+            participant_pdb.log_prepare_of(transaction_id)
+
+        commit_threads = [threading.Thread(target=p.log_commit_of, args=(t,))
+                          for t, p in zip(transaction_ids, participant_pdbs)]
+        [t.start() for t in commit_threads]
+        [t.join() for t in commit_threads]
+
+        # All of our commits must be durable (and visible) once log_commit_of returns.
+        self.assertEqual(len(participant_pdbs[0].get_prepared_transactions()), 0)
+        self.assertEqual(len(participant_pdbs[0].get_abortable_transactions()), 0)
+
+        [p.close() for p in participant_pdbs]
+        time.sleep(0.5)
+
+    def test_deferred_writes(self):
+        transaction_id = str(uuid.uuid4())
+
+        participant_pdb = protocol.ProtocolDatabase('participant_' + self.test_file, 0.01)
+        initialize_requests = [
+            participant_pdb.log_initialize_of(transaction_id, TransactionRole.PARTICIPANT, is_blocking=False),
+            participant_pdb.add_coordinator(transaction_id, 1, is_blocking=False)
+        ]
+        [r.wait() for r in initialize_requests]
+
+        # Our non-blocking writes must be visible once they have been waited on.
+        self.assertEqual(participant_pdb.get_role_in(transaction_id), TransactionRole.PARTICIPANT)
+        self.assertEqual(participant_pdb.get_coordinator_for(transaction_id), 1)
+        self.assertIn(transaction_id, participant_pdb.get_abortable_transactions())
+
+        participant_pdb.log_abort_of(transaction_id)
+        participant_pdb.log_completion_of(transaction_id)
+        self.assertEqual(len(participant_pdb.get_abortable_transactions()), 0)
+
+        participant_pdb.close()
+        time.sleep(0.5)
+
+    def test_batched_writes(self):
+        transaction_id_1 = str(uuid.uuid4())
+        transaction_id_2 = str(uuid.uuid4())
+
+        participant_pdb = protocol.ProtocolDatabase('participant_' + self.test_file, 0.01)
+        with participant_pdb.batch() as request:
+            self.assertIs(participant_pdb.log_initialize_of(transaction_id_1, TransactionRole.PARTICIPANT), request)
+            self.assertIs(participant_pdb.add_coordinator(transaction_id_1, 1), request)
+        self.assertEqual(participant_pdb.get_coordinator_for(transaction_id_1), 1)
+        self.assertIn(transaction_id_1, participant_pdb.get_abortable_transactions())
+
+        # Nothing written within a failed batch is committed.
+        with self.assertRaises(ValueError):
+            with participant_pdb.batch():
+                participant_pdb.log_initialize_of(transaction_id_2, TransactionRole.PARTICIPANT)
+                raise ValueError
+        self.assertNotIn(transaction_id_2, participant_pdb.get_abortable_transactions())
+
+        participant_pdb.close()
+        time.sleep(0.5)
+
+    def test_status_backfill(self):
+        transaction_id_1 = str(uuid.uuid4())
+        transaction_id_2 = str(uuid.uuid4())
+
+        # Build a protocol database from before the status table existed.
+        conn = sqlite3.connect('coordinator_' + self.test_file)
+        conn.execute("CREATE TABLE STATE_LOG (tr_id TEXT, state TEXT);")
+        conn.executemany("INSERT INTO STATE_LOG (tr_id, state) VALUES (?, ?);",
+                         [(transaction_id_1, "I"), (transaction_id_2, "I"), (transaction_id_1, "P")])
+        conn.commit()
+        conn.close()
+
+        coordinator_pdb = protocol.ProtocolDatabase('coordinator_' + self.test_file)
+        self.assertEqual(coordinator_pdb.get_abortable_transactions(), [transaction_id_2])
+        self.assertEqual(coordinator_pdb.get_prepared_transactions(), [transaction_id_1])
+
+        coordinator_pdb.close()
+        time.sleep(0.5)
+
 
 if __name__ == "__main__":
     import sys
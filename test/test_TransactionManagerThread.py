@@ -297,13 +297,6 @@ class TestTransactionManagerThread(unittest.TestCase):
         conn.tpc_prepare()
         pdb1.close()
 
-        class TestRM(object):
-            def tpc_recover(self):
-                return []
-
-            def close(self):
-                pass
-
         manager_thread_1 = manager.TransactionManagerThread(
             **self.get_postgres_context(),
             protocol_db=self.test_file + '1',
@@ -317,7 +310,6 @@ class TestTransactionManagerThread(unittest.TestCase):
         )
         manager_thread_2 = manager.TransactionManagerThread(
             **self.get_postgres_context(),
-            test_rm=TestRM(),
             protocol_db=self.test_file,
             role_factory=_TestDummyTransactionRoleFactory(),
             site_alias=socket.gethostname(),
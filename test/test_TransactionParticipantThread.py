@@ -37,12 +37,12 @@ class TestTransactionParticipantThread(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls) -> None:
-        try:
-            os.remove(cls.test_file)
-            os.remove(cls.test_file + '-journal')
+        for suffix in ['', '-wal', '-shm']:
+            try:
+                os.remove(cls.test_file + suffix)
 
-        except OSError:
-            pass
+            except OSError:
+                pass
 
         try:
             conn = cls.get_postgres_connection()
@@ -328,3 +328,43 @@ class TestTransactionParticipantThread(unittest.TestCase):
         cur.execute(""" SELECT COUNT(*) FROM thermometerobservation; """)
         result = cur.fetchone()
         self.assertEqual(result[0], 1)
+
+    def test_connection_returned_on_failure(self):
+        participant_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        participant_socket.bind((socket.gethostname(), self.test_port + 6))
+        participant_socket.listen(5)
+
+        # Connect to our coordinator.
+        coordinator_socket = communication.GenericSocketUser()
+        coordinator_socket.socket.connect((socket.gethostname(), self.test_port + 6,))
+        from_coordinator_socket, from_coordinator_address = participant_socket.accept()
+        participant_thread = participate.TransactionParticipantThread(
+            **self.get_postgres_context(),
+            transaction_coordinator=1,
+            transaction_id=str(uuid.uuid4()),
+            client_socket=from_coordinator_socket,
+            protocol_db=self.test_file,
+            failure_time=5,
+        )
+        used_connections = len(participant_thread.rm_pool._used) - 1  # Our participant has borrowed one.
+        participant_thread.start()
+        time.sleep(0.01)
+
+        # Drop our participant's RM connection, so both the INSERT and the ROLLBACK that follows it fail.
+        conn = self.get_postgres_connection()
+        cur = conn.cursor()
+        cur.execute(""" SELECT pg_terminate_backend(%s); """, (participant_thread.conn.get_backend_pid(),))
+        conn.close()
+
+        coordinator_socket.send_message(OpCode.INSERT_FROM_COORDINATOR, ["""
+            INSERT INTO thermometerobservation 
+            VALUES ('a239a033-b340-426d-a686-ad32908709ae', 48, '2017-11-08 00:00:00', 
+                    '9592a785_d3a4_4de2_bc3d_cfa1a127bf40');
+        """])
+        participant_thread.join()
+        participant_socket.close()
+        coordinator_socket.close()
+
+        # Our participant has exited through an exception, but its connection must still be returned to the pool.
+        self.assertEqual(len(participant_thread.rm_pool._used), used_connections)
+        self.assertTrue(participant_thread.conn.closed)